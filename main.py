@@ -1,12 +1,29 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import boto3
 import argparse
+import asyncio
+import gzip
+import hashlib
+import json
 import logging
 import os
 import re
+import sqlite3
+import sys
 import textwrap
+import threading
 import time
-from botocore.exceptions import ClientError
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+from boto3.s3.transfer import TransferConfig
+from botocore import xform_name
+from botocore.config import Config
+from botocore.exceptions import ClientError, WaiterError
+from botocore.paginate import Paginator
+from botocore.waiter import Waiter, WaiterModel, create_waiter_with_client
 from dateutil.parser import parse
 
 
@@ -17,95 +34,803 @@ logging.basicConfig(
 
 S3_BUCKET_NAME = "textract-console-us-east-1-1b79e4f8-575e-4e6b-b80c-9d6cf5953a01"
 
+# Optional job completion notifications. When all three are set, Textract
+# publishes job completion to the SNS topic and we long-poll the SQS queue
+# subscribed to it instead of polling the Get* APIs every few seconds.
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get("TEXTRACT_SNS_TOPIC_ARN")
+TEXTRACT_SNS_ROLE_ARN = os.environ.get("TEXTRACT_SNS_ROLE_ARN")
+TEXTRACT_SQS_QUEUE_URL = os.environ.get("TEXTRACT_SQS_QUEUE_URL")
+
+# Status polling used when completion notifications are not configured.
+JOB_POLL_DELAY_SECONDS = 2
+
+# Optional limit on how long to wait for a Textract job, in seconds. By default
+# jobs are waited on until they finish.
+JOB_TIMEOUT_SECONDS = float(os.environ.get("TEXTRACT_JOB_TIMEOUT_SECONDS", "0")) or None
+
+# How often a job waiting for its completion notification re-checks its status,
+# in case the notification was lost.
+JOB_STATUS_RECHECK_SECONDS = 60
+
+# Requested results per Get* page. Textract caps this per operation
+# (e.g. 20 for GetExpenseAnalysis, 1000 for GetDocumentAnalysis).
+RESULTS_PAGE_SIZE = 1000
+
+# Documents up to this size are first sent inline to the synchronous Textract
+# APIs, skipping the S3 upload and job polling.
+SYNC_MAX_DOCUMENT_BYTES = 5 * 1024 * 1024
+
+# Local SQLite cache of parsed results, keyed by the SHA-256 of the file content,
+# so that re-running on the same invoice skips Textract and S3 entirely.
+CACHE_PATH = os.environ.get("TEXTRACT_CACHE_PATH", ".textract_cache.sqlite3")
+
+# Maximum number of invoice files processed at the same time. Keeps the number
+# of concurrent Textract jobs within the account's TPS quotas.
+MAX_CONCURRENT_FILES = 10
+
+# Fetches the next page of job results while the current one is processed.
+# Each pagination has at most one fetch in flight.
+_PAGE_FETCH_POOL = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILES)
+
+# Upload PDFs larger than 8 MB as parallel multipart uploads.
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# Shared, thread-safe clients reused for every file. Adaptive retries back off
+# (with jitter) on throttling such as ProvisionedThroughputExceededException,
+# the larger pool lets concurrent files and multipart uploads share it, and
+# TCP keep-alive keeps idle pooled connections open between polls.
+_CFG = Config(
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    max_pool_connections=50,
+    tcp_keepalive=True,
+)
+
+
+def _request_gzip(request: Any, **kwargs: Any) -> None:
+    """Asks for a gzip-compressed response body (botocore event handler)."""
+    request.headers["Accept-Encoding"] = "gzip"
+
+
+def _decompress_gzip(response_dict: Dict[str, Any], **kwargs: Any) -> None:
+    """
+    Decompresses a gzip-encoded response body before botocore parses it, as
+    botocore does not decode compressed responses itself (event handler).
+    """
+    if response_dict["headers"].get("Content-Encoding") == "gzip":
+        response_dict["body"] = gzip.decompress(response_dict["body"])
+
+
+TEXTRACT = boto3.client("textract", config=_CFG)
+# Textract results are large JSON documents, so request them compressed.
+TEXTRACT.meta.events.register("before-sign.textract.*", _request_gzip)
+TEXTRACT.meta.events.register("before-parse.textract.*", _decompress_gzip)
+S3 = boto3.client("s3", config=_CFG)
+SQS = boto3.client("sqs", config=_CFG)
+
+# Questions asked by the payment terms fallback (AnalyzeDocument QUERIES),
+# applied to every page of the document.
+PAYMENT_TERMS_QUERIES = [
+    {"Text": "What are the payment terms?", "Alias": "PAYMENT_TERMS", "Pages": ["*"]},
+    {"Text": "When is payment due?", "Alias": "DUE_DATE", "Pages": ["*"]},
+]
+
+# Phrases that mark a line of raw text as describing payment terms, used when
+# the payment terms queries return no answer.
+PAYMENT_TERMS_KEYWORDS = (
+    "terms of payment",
+    "payment is due",
+    "late payment",
+    "immediate payment",
+    "payment terms",
+    "please pay",
+    "terms:",
+    "balance due",
+    "unpaid for",
+    "penalty",
+    "interest",
+    "please remit",
+    "net 15",
+    "net 30",
+    "net 60",
+    "net 90",
+    "due upon receipt",
+)
+# Matches any of the keywords in a single pass over a line.
+_PAYMENT_TERMS_RE = re.compile(
+    "|".join(re.escape(keyword) for keyword in PAYMENT_TERMS_KEYWORDS), re.IGNORECASE
+)
+
+# Currency symbols and whitespace stripped before parsing amounts.
+_CURRENCY_RE = re.compile(r"[€$\s]")
+
+# Summary fields that should NOT be treated as line items by the
+# parse_extracted_data fallback.
+EXCLUDED_SUMMARY_TYPES = frozenset(
+    {
+        "TOTAL",
+        "TAX",
+        "INVOICE_RECEIPT_ID",
+        "INVOICE_RECEIPT_DATE",
+        "VENDOR_NAME",
+        "VENDOR_ADDRESS",
+        "RECEIVER_NAME",
+        "RECEIVER_ADDRESS",
+        "DUE_DATE",
+        "PAYMENT_TERMS",
+        "TERMS",
+        "SHIPPING_HANDLING_CHARGE",
+        "GRATUITY",
+        "ADDRESS",
+        "STREET",
+        "CITY",
+        "STATE",
+        "ZIP_CODE",
+        "NAME",
+        "ADDRESS_BLOCK",
+        "CLIENT_MATTER",
+        "CLIENT_ID",
+    }
+)
+
+# Reusable wrappers for display_results, so that their regexes are not rebuilt
+# for every line item.
+_DESC_WRAPPER = textwrap.TextWrapper(width=50)
+_TERMS_WRAPPER = textwrap.TextWrapper(
+    width=98,
+    initial_indent="Payment Terms:  ",
+    subsequent_indent="                ",
+)
+
+# Events of the jobs currently waiting for a completion notification, keyed by
+# JobId, and the status each notification reported. A single receiver thread
+# long-polls the queue while any job is waiting and wakes the matching waiters.
+_job_notification_events: Dict[str, List[threading.Event]] = {}
+_job_notifications: Dict[str, str] = {}
+_job_notifications_lock = threading.Lock()
+_notification_receiver: Optional[threading.Thread] = None
+
+# Set when processing ends or is interrupted, so that job waits still running
+# in worker threads return instead of blocking shutdown until their jobs finish.
+_stop_waiting = threading.Event()
+
+def _notification_channel() -> Dict[str, Any]:
+    """
+    Builds the extra start_* arguments that enable SNS completion notifications.
+
+    Returns:
+        A dictionary with the NotificationChannel parameter, or an empty
+        dictionary if SNS/SQS notifications are not configured.
+    """
+    if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_SNS_ROLE_ARN and TEXTRACT_SQS_QUEUE_URL:
+        return {
+            "NotificationChannel": {
+                "SNSTopicArn": TEXTRACT_SNS_TOPIC_ARN,
+                "RoleArn": TEXTRACT_SNS_ROLE_ARN,
+            }
+        }
+    return {}
+
+
+def _client_request_token(bucket_name: str, digest: str) -> str:
+    """
+    Derives a stable idempotency token for the Textract jobs of a file.
+
+    Starting a job again with the same token (e.g. when re-running on an
+    unchanged file) returns the existing JobId instead of creating a new job.
+
+    Args:
+        bucket_name: The S3 bucket where the document is located.
+        digest: The SHA-256 hex digest of the document content.
+
+    Returns:
+        A 64 character hex token.
+    """
+    return hashlib.sha256(f"{bucket_name}|{digest}".encode()).hexdigest()
+
+
+def _job_tag(object_name: str) -> str:
+    """
+    Converts a document name into a valid Textract JobTag.
+
+    Args:
+        object_name: The name (key) of the document in the S3 bucket.
+
+    Returns:
+        The file name part of the key with unsupported characters replaced,
+        truncated to 64 characters.
+    """
+    return re.sub(r"[^a-zA-Z0-9_.\-:]", "_", os.path.basename(object_name))[:64]
+
+
+def _idempotency_args(client_request_token: Optional[str]) -> Dict[str, Any]:
+    """
+    Builds the extra start_* arguments for an optional idempotency token.
+
+    Args:
+        client_request_token: The token, or None to always start a new job.
+
+    Returns:
+        A dictionary with the ClientRequestToken parameter, or an empty
+        dictionary if no token was given.
+    """
+    return {"ClientRequestToken": client_request_token} if client_request_token else {}
+
+
+def _is_notification_channel_error(error: ClientError) -> bool:
+    """
+    Checks whether a start_* call failed because of its NotificationChannel,
+    e.g. because Textract may not assume the role or publish to the topic.
+
+    Args:
+        error: The error raised by the start_* call.
+
+    Returns:
+        True if the job may succeed when started without the channel.
+    """
+    code = error.response.get("Error", {}).get("Code")
+    message = error.response.get("Error", {}).get("Message", "")
+    if code == "AccessDeniedException":
+        return True
+    return code == "InvalidParameterException" and any(
+        name in message for name in ("NotificationChannel", "SNSTopicArn", "RoleArn")
+    )
+
+
+def _start_job(start_job: Callable[..., Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+    """
+    Starts an asynchronous Textract job, requesting a completion notification
+    when configured.
+
+    If the job cannot be started with the notification channel (e.g. the role
+    is not allowed to publish to the topic), it is started again without one
+    and the caller falls back to polling. If a ClientRequestToken was already
+    used with different parameters, the job is started with a fresh token.
+
+    Args:
+        start_job: The Textract start_* client method to call.
+        **kwargs: The arguments for the start_* call.
+
+    Returns:
+        The start_* response, with a "NotificationsEnabled" flag added.
+    """
+
+    def start(**extra: Any) -> Dict[str, Any]:
+        try:
+            return start_job(**kwargs, **extra)
+        except ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            if (
+                error_code != "IdempotentParameterMismatchException"
+                or "ClientRequestToken" not in kwargs
+            ):
+                raise
+            logging.warning(
+                "ClientRequestToken was already used with other parameters. "
+                "Starting a new job."
+            )
+            new_token = uuid.uuid4().hex
+            return start_job(**{**kwargs, "ClientRequestToken": new_token}, **extra)
+
+    channel = _notification_channel()
+    if channel:
+        try:
+            response = start(**channel)
+            response["NotificationsEnabled"] = True
+            return response
+        except ClientError as e:
+            if not _is_notification_channel_error(e):
+                raise
+            logging.warning(
+                f"Could not start job with SNS notifications, falling back to polling: {e}"
+            )
+    response = start()
+    response["NotificationsEnabled"] = False
+    return response
+
+
+def _receive_job_notifications() -> None:
+    """
+    Long-polls the notification queue while any job is waiting for its
+    completion notification, and wakes the waiters of each job that completes.
+
+    Runs in a single background thread. Notifications for jobs nobody is
+    waiting on are dropped; such jobs see their final status when they start
+    waiting.
+    """
+    global _notification_receiver
+    while True:
+        with _job_notifications_lock:
+            if not _job_notification_events:
+                _notification_receiver = None
+                return
+        try:
+            response = SQS.receive_message(
+                QueueUrl=TEXTRACT_SQS_QUEUE_URL,
+                WaitTimeSeconds=20,
+                MaxNumberOfMessages=10,
+            )
+            for message in response.get("Messages", []):
+                try:
+                    body = json.loads(message["Body"])
+                    # Without raw message delivery the Textract payload is
+                    # wrapped in an SNS envelope.
+                    notification = (
+                        json.loads(body["Message"]) if "Message" in body else body
+                    )
+                    job_id = notification["JobId"]
+                    status = notification["Status"]
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(
+                        f"Ignoring unexpected message on notification queue: {message.get('MessageId')}"
+                    )
+                else:
+                    with _job_notifications_lock:
+                        events = _job_notification_events.get(job_id)
+                        if events:
+                            _job_notifications[job_id] = status
+                            for event in events:
+                                event.set()
+                SQS.delete_message(
+                    QueueUrl=TEXTRACT_SQS_QUEUE_URL,
+                    ReceiptHandle=message["ReceiptHandle"],
+                )
+        except Exception as e:
+            # Waiters keep re-checking the job status, so keep receiving.
+            logging.warning(f"Could not receive job notifications: {e}")
+            time.sleep(JOB_POLL_DELAY_SECONDS)
+
+
+def _register_notification_waiter(job_id: str) -> threading.Event:
+    """
+    Registers interest in the completion notification of a job, starting the
+    notification receiver thread if it is not running.
+
+    Args:
+        job_id: The ID of the job to wait for.
+
+    Returns:
+        An event that is set once the job's completion notification arrives.
+    """
+    global _notification_receiver
+    event = threading.Event()
+    with _job_notifications_lock:
+        _job_notification_events.setdefault(job_id, []).append(event)
+        if _notification_receiver is None:
+            _notification_receiver = threading.Thread(
+                target=_receive_job_notifications,
+                name="textract-notifications",
+                daemon=True,
+            )
+            _notification_receiver.start()
+    return event
+
+
+def _unregister_notification_waiter(job_id: str, event: threading.Event) -> None:
+    """
+    Removes a waiter registered with _register_notification_waiter, forgetting
+    the job's notification once nobody is waiting on it.
+
+    Args:
+        job_id: The ID of the job that was waited for.
+        event: The event returned when registering.
+    """
+    with _job_notifications_lock:
+        events = _job_notification_events[job_id]
+        events.remove(event)
+        if not events:
+            del _job_notification_events[job_id]
+            _job_notifications.pop(job_id, None)
+
+
+@lru_cache(maxsize=None)
+def _job_waiter(operation_name: str) -> Waiter:
+    """
+    Builds a botocore waiter that waits for an asynchronous Textract job to
+    leave the IN_PROGRESS state.
+
+    Args:
+        operation_name: The Textract Get* operation reporting the job status,
+            e.g. "GetExpenseAnalysis".
+
+    Returns:
+        A waiter for the shared Textract client.
+    """
+    model = WaiterModel(
+        {
+            "version": 2,
+            "waiters": {
+                "JobCompleted": {
+                    "operation": operation_name,
+                    # Polled one attempt at a time by _wait_for_job, so that
+                    # the delay between polls can be interrupted.
+                    "delay": JOB_POLL_DELAY_SECONDS,
+                    "maxAttempts": 1,
+                    "acceptors": [
+                        {
+                            "matcher": "path",
+                            "argument": "JobStatus",
+                            "expected": status,
+                            "state": state,
+                        }
+                        for status, state in (
+                            ("SUCCEEDED", "success"),
+                            ("FAILED", "failure"),
+                            ("PARTIAL_SUCCESS", "failure"),
+                        )
+                    ],
+                }
+            },
+        }
+    )
+    return create_waiter_with_client("JobCompleted", model, TEXTRACT)
+
+
+@lru_cache(maxsize=None)
+def _job_results_paginator(operation_name: str, result_key: str) -> Paginator:
+    """
+    Builds a botocore paginator over the results of an asynchronous Textract
+    job. Textract does not ship paginators for its Get* job operations.
+
+    Args:
+        operation_name: The Textract Get* operation returning the job results,
+            e.g. "GetExpenseAnalysis".
+        result_key: The list in each page that holds the results.
+
+    Returns:
+        A paginator for the shared Textract client.
+    """
+    return Paginator(
+        getattr(TEXTRACT, xform_name(operation_name)),
+        {
+            "input_token": "NextToken",
+            "output_token": "NextToken",
+            "limit_key": "MaxResults",
+            "result_key": result_key,
+        },
+        TEXTRACT.meta.service_model.operation_model(operation_name),
+    )
+
+
+def _prefetch_pages(pages: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Yields result pages while fetching the following page in the background.
+
+    Each page's NextToken is only known once it arrives, so pages cannot be
+    requested in parallel. Instead, the request for the next page overlaps
+    with the processing of the current one.
+
+    Args:
+        pages: The page iterator returned by a paginator.
+
+    Yields:
+        The pages, in order.
+    """
+    page_iter = iter(pages)
+    next_page = _PAGE_FETCH_POOL.submit(next, page_iter, None)
+    while True:
+        page = next_page.result()
+        if page is None:
+            return
+        next_page = _PAGE_FETCH_POOL.submit(next, page_iter, None)
+        yield page
+
+
+def _job_timed_out(job_id: str, deadline: Optional[float]) -> bool:
+    """
+    Checks whether the wait for a job has exceeded JOB_TIMEOUT_SECONDS,
+    logging it if so.
+
+    Args:
+        job_id: The ID of the job being waited for.
+        deadline: The time.monotonic() value at which to give up, or None to
+            wait indefinitely.
+
+    Returns:
+        True if the deadline has passed.
+    """
+    if deadline is None or time.monotonic() < deadline:
+        return False
+    logging.error(
+        f"Timed out after {JOB_TIMEOUT_SECONDS:g} seconds waiting for job {job_id}, "
+        "which is still IN_PROGRESS."
+    )
+    return True
+
+
+def _stop_job_waits() -> None:
+    """
+    Makes all running and future job waits return without waiting for their
+    jobs to finish.
+    """
+    with _job_notifications_lock:
+        _stop_waiting.set()
+        for events in _job_notification_events.values():
+            for event in events:
+                event.set()
+
+
+def _job_wait_stopped(job_id: str) -> bool:
+    """
+    Checks whether job waits were stopped (see _stop_job_waits), logging it if
+    so.
+
+    Args:
+        job_id: The ID of the job being waited for.
+
+    Returns:
+        True if the wait should stop.
+    """
+    if not _stop_waiting.is_set():
+        return False
+    logging.warning(f"Stopped waiting for job {job_id}, which is still IN_PROGRESS.")
+    return True
+
+
+def _wait_for_job(operation_name: str, job_id: str, notifications_enabled: bool) -> str:
+    """
+    Waits for an asynchronous Textract job to leave the IN_PROGRESS state, for
+    at most JOB_TIMEOUT_SECONDS if it is set.
+
+    With notifications enabled this blocks until the notification receiver
+    thread reports the job's completion, re-checking the job status every
+    JOB_STATUS_RECHECK_SECONDS in case the notification was lost.
+    Otherwise the job status is polled with a botocore waiter.
+
+    Args:
+        operation_name: The Textract Get* operation reporting the job status,
+            e.g. "GetExpenseAnalysis".
+        job_id: The ID of the job to wait for.
+        notifications_enabled: Whether the job was started with an SNS
+            notification channel.
+
+    Returns:
+        The final job status (SUCCEEDED, FAILED or PARTIAL_SUCCESS), or
+        IN_PROGRESS if the wait timed out or was stopped. FAILED is also
+        returned if the job status cannot be read (e.g. an expired JobId).
+    """
+    deadline = time.monotonic() + JOB_TIMEOUT_SECONDS if JOB_TIMEOUT_SECONDS else None
+
+    if notifications_enabled:
+        get_job = getattr(TEXTRACT, xform_name(operation_name))
+        event = _register_notification_waiter(job_id)
+        try:
+            while not _job_wait_stopped(job_id):
+                # Checked after registering, so that a job which completed
+                # before (e.g. an existing job returned for a reused
+                # ClientRequestToken) is seen here, and one completing later
+                # sets the event.
+                try:
+                    job_status = get_job(JobId=job_id, MaxResults=1)["JobStatus"]
+                except ClientError as e:
+                    logging.error(f"Could not get the status of job {job_id}: {e}")
+                    return "FAILED"
+                if job_status != "IN_PROGRESS" or _job_timed_out(job_id, deadline):
+                    return job_status
+                timeout = JOB_STATUS_RECHECK_SECONDS
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.monotonic())
+                if event.wait(timeout) and not _stop_waiting.is_set():
+                    with _job_notifications_lock:
+                        job_status = _job_notifications[job_id]
+                    logging.info(
+                        f"Job {job_id} completion notification received: {job_status}"
+                    )
+                    return job_status
+            return "IN_PROGRESS"
+        finally:
+            _unregister_notification_waiter(job_id, event)
+
+    waiter = _job_waiter(operation_name)
+    while not _job_wait_stopped(job_id):
+        try:
+            waiter.wait(JobId=job_id, MaxResults=1)
+        except WaiterError as e:
+            job_status = e.last_response.get("JobStatus")
+            if not job_status:
+                logging.error(f"Could not get the status of job {job_id}: {e}")
+                return "FAILED"
+            if job_status != "IN_PROGRESS" or _job_timed_out(job_id, deadline):
+                return job_status
+        else:
+            return "SUCCEEDED"
+        delay = JOB_POLL_DELAY_SECONDS
+        if deadline is not None:
+            delay = max(0, min(delay, deadline - time.monotonic()))
+        _stop_waiting.wait(delay)
+    return "IN_PROGRESS"
+
+
+def _run_job(
+    start: Callable[[Optional[str]], Dict[str, Any]],
+    operation_name: str,
+    client_request_token: Optional[str],
+) -> Tuple[str, str]:
+    """
+    Starts an asynchronous Textract job and waits for it to leave the
+    IN_PROGRESS state.
+
+    A reused ClientRequestToken returns the job of an earlier run, which may
+    have failed or expired. If a job started with a token does not succeed,
+    it is started once more with a fresh token.
+
+    Args:
+        start: Starts the job with the given ClientRequestToken (or None) and
+            returns the start response (see _start_job).
+        operation_name: The Textract Get* operation reporting the job status,
+            e.g. "GetExpenseAnalysis".
+        client_request_token: Optional idempotency token for the job.
+
+    Returns:
+        The JobId and the final job status (see _wait_for_job).
+    """
+    response = start(client_request_token)
+    job_status = _wait_for_job(
+        operation_name, response["JobId"], response["NotificationsEnabled"]
+    )
+    if client_request_token and job_status in ("FAILED", "PARTIAL_SUCCESS"):
+        logging.warning(
+            f"Job {response['JobId']} ended with status {job_status}. "
+            "Starting a new job with a fresh ClientRequestToken."
+        )
+        response = start(uuid.uuid4().hex)
+        job_status = _wait_for_job(
+            operation_name, response["JobId"], response["NotificationsEnabled"]
+        )
+    return response["JobId"], job_status
+
+
+def _find_payment_terms(blocks: Iterable[Dict[str, Any]]) -> Optional[str]:
+    """
+    Extracts the payment terms from the Blocks of a payment terms document
+    analysis.
+
+    The answer to the PAYMENT_TERMS query is preferred. If Textract found no
+    answer to it, the LINE blocks where payment terms keywords were found are
+    used instead. Any answer to the DUE_DATE query is added in both cases.
+
+    Args:
+        blocks: The Blocks returned by Textract.
+
+    Returns:
+        A string containing the payment terms found, or None if nothing was
+        found.
+    """
+    query_results = {}
+    query_answers = []
+    found_terms = []
+    logging.info("Searching for payment terms in the analysis results...")
+    for block in blocks:
+        block_type = block.get("BlockType")
+        if block_type == "QUERY_RESULT":
+            query_results[block.get("Id")] = block.get("Text")
+        elif block_type == "QUERY":
+            alias = block.get("Query", {}).get("Alias")
+            for relationship in block.get("Relationships", []):
+                if relationship.get("Type") == "ANSWER":
+                    for answer_id in relationship.get("Ids", []):
+                        query_answers.append((alias, answer_id))
+        elif block_type == "LINE":
+            if _PAYMENT_TERMS_RE.search(block.get("Text", "")):
+                found_terms.append(block.get("Text"))
+
+    # A query is answered separately on every page, so drop repeated answers.
+    answers = {"PAYMENT_TERMS": {}, "DUE_DATE": {}}
+    for alias, answer_id in query_answers:
+        if alias in answers and query_results.get(answer_id):
+            answers[alias][query_results[answer_id]] = None
+    terms = list(answers["PAYMENT_TERMS"]) or found_terms
+    terms.extend(answer for answer in answers["DUE_DATE"] if answer not in terms)
+    return " ".join(terms) if terms else None
+
+
+def start_fallback_job(
+    bucket_name: str, object_name: str, client_request_token: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Starts the AnalyzeDocument (QUERIES) job used by the payment terms fallback.
+
+    Args:
+        bucket_name: The S3 bucket where the document is located.
+        object_name: The name (key) of the document in the S3 bucket.
+        client_request_token: Optional idempotency token for the job.
+
+    Returns:
+        The start response (see _start_job).
+    """
+    response = _start_job(
+        TEXTRACT.start_document_analysis,
+        DocumentLocation={"S3Object": {"Bucket": bucket_name, "Name": object_name}},
+        FeatureTypes=["QUERIES"],
+        QueriesConfig={"Queries": PAYMENT_TERMS_QUERIES},
+        JobTag=_job_tag(object_name),
+        **_idempotency_args(client_request_token),
+    )
+    logging.info(f"Fallback job started with ID: {response['JobId']}")
+    return response
+
 
-def fallback_find_payment_terms(bucket_name: str, object_name: str) -> Optional[str]:
+def fallback_find_payment_terms(
+    bucket_name: str,
+    object_name: str,
+    client_request_token: Optional[str] = None,
+) -> Optional[str]:
     """
-    Uses DetectDocumentText as a fallback to find payment terms.
+    Uses AnalyzeDocument queries as a fallback to find payment terms.
 
     This is called when AnalyzeExpense fails to identify the PAYMENT_TERMS field.
-    It starts a text detection job, waits for it to succeed by polling its
-    status, and then scans the raw text for a predefined list of keywords.
+    It waits for the document analysis job to complete (via SNS/SQS
+    notification when configured, otherwise by polling), and then reads the
+    answers to the payment terms queries, falling back to scanning the raw
+    text for a predefined list of keywords.
 
     Args:
         bucket_name: The S3 bucket where the document is located.
         object_name: The name (key) of the document in the S3 bucket.
+        client_request_token: Optional idempotency token for the job.
 
     Returns:
-        A string containing the concatenated lines where payment terms were found,
-        or None if no terms were found or an error occurred.
+        A string containing the payment terms found, or None if no terms were
+        found.
+
+    Raises:
+        RuntimeError: If the document analysis job did not succeed.
+        ClientError: If a Textract call failed.
     """
     logging.info(
-        f"Executing fallback text detection for s3://{bucket_name}/{object_name}"
+        f"Executing fallback document analysis for s3://{bucket_name}/{object_name}"
     )
-    textract_client = boto3.client("textract")
 
-    try:
-        # 1. Start the asynchronous Textract job
-        response = textract_client.start_document_text_detection(
-            DocumentLocation={"S3Object": {"Bucket": bucket_name, "Name": object_name}}
-        )
-        job_id = response["JobId"]
-        logging.info(f"Fallback job started with ID: {job_id}")
-
-        # 2. Wait for the job to complete
-        job_status = ""
-        while job_status != "SUCCEEDED":
-            time.sleep(5)
-            result = textract_client.get_document_text_detection(JobId=job_id)
-            job_status = result["JobStatus"]
-            logging.info(f"Fallback job status: {job_status}")
-            if job_status in ["FAILED", "PARTIAL_SUCCESS"]:
-                logging.error(f"Fallback Textract job failed with status: {job_status}")
-                return None
-
-        # 3. Once successful, fetch all results (handles pagination)
-        logging.info("Fallback job succeeded. Fetching all pages of results...")
-        pages = []
-        get_pages_result = textract_client.get_document_text_detection(JobId=job_id)
-        pages.append(get_pages_result)
-        next_token = get_pages_result.get("NextToken")
-        while next_token:
-            get_pages_result = textract_client.get_document_text_detection(
-                JobId=job_id, NextToken=next_token
-            )
-            pages.append(get_pages_result)
-            next_token = get_pages_result.get("NextToken")
-
-        # 4. Process the results to find payment terms keywords
-        payment_terms_keywords = (
-            "terms of payment",
-            "payment is due",
-            "late payment",
-            "immediate payment",
-            "payment terms",
-            "please pay",
-            "terms:",
-            "balance due",
-            "unpaid for",
-            "penalty",
-            "interest",
-            "please remit",
-            "net 15",
-            "net 30",
-            "net 60",
-            "net 90",
-            "due upon receipt",
+    # 1. Start the asynchronous Textract job and wait for it to complete
+    job_id, job_status = _run_job(
+        lambda token: start_fallback_job(bucket_name, object_name, token),
+        "GetDocumentAnalysis",
+        client_request_token,
+    )
+    logging.info(f"Fallback job status: {job_status}")
+    if job_status != "SUCCEEDED":
+        raise RuntimeError(f"Fallback Textract job ended with status: {job_status}")
+
+    # 2. Once successful, fetch all results (handles pagination)
+    logging.info("Fallback job succeeded. Fetching all pages of results...")
+    pages = _prefetch_pages(
+        _job_results_paginator("GetDocumentAnalysis", "Blocks").paginate(
+            JobId=job_id, PaginationConfig={"PageSize": RESULTS_PAGE_SIZE}
         )
+    )
 
-        found_terms = []
-        logging.info("Searching for payment terms in the raw text...")
-        for page in pages:
-            for block in page.get("Blocks", []):
-                if block.get("BlockType") == "LINE":
-                    line_text = block.get("Text", "").lower()
-                    if any(keyword in line_text for keyword in payment_terms_keywords):
-                        found_terms.append(block.get("Text"))
+    # 3. Process the results to find the payment terms
+    return _find_payment_terms(
+        block for page in pages for block in page.get("Blocks", [])
+    )
 
-        return " ".join(found_terms) if found_terms else None
 
-    except Exception as e:
-        logging.error(f"An error occurred during fallback processing: {e}")
-        return None
+def fallback_find_payment_terms_sync(document_bytes: bytes) -> Optional[str]:
+    """
+    Uses synchronous AnalyzeDocument queries as a fallback to find payment
+    terms in a small single-page document passed inline.
+
+    Args:
+        document_bytes: The content of the document.
+
+    Returns:
+        A string containing the payment terms found, or None if no terms were
+        found.
+
+    Raises:
+        ClientError: If the Textract call failed.
+    """
+    logging.info("Executing synchronous fallback document analysis...")
+    response = TEXTRACT.analyze_document(
+        Document={"Bytes": document_bytes},
+        FeatureTypes=["QUERIES"],
+        QueriesConfig={"Queries": PAYMENT_TERMS_QUERIES},
+    )
+    return _find_payment_terms(response.get("Blocks", []))
 
 def standardize_date(date_str: str) -> str:
     """
@@ -170,7 +895,12 @@ def _parse_float(value_str: Optional[str]) -> Optional[float]:
     if not value_str:
         return None
     try:
-        cleaned_str = re.sub(r"[€$ ]", "", str(value_str)).strip()
+        cleaned_str = _CURRENCY_RE.sub("", str(value_str))
+        # Fast path: plain numbers without a comma separator parse directly.
+        try:
+            return float(cleaned_str)
+        except ValueError:
+            pass
         num_commas = cleaned_str.count(",")
         num_periods = cleaned_str.count(".")
         if (
@@ -190,54 +920,147 @@ def _parse_float(value_str: Optional[str]) -> Optional[float]:
         return None
 
 
-def analyze_invoice_primary(bucket_name: str, file_name: str) -> Optional[Dict[str, Any]]:
+def _compact_expense_field(field: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Strips an ExpenseField down to the text of its type, value and label.
+
+    Args:
+        field: A SummaryField or LineItemExpenseField from Textract.
+
+    Returns:
+        The field with only Type, ValueDetection and LabelDetection "Text" kept.
+    """
+    compact_field = {}
+    for key in ("Type", "ValueDetection", "LabelDetection"):
+        detection = field.get(key)
+        if detection is not None:
+            compact_field[key] = {"Text": detection.get("Text")}
+    return compact_field
+
+
+def _compact_expense_document(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Keeps only the parts of an ExpenseDocument read by parse_extracted_data.
+
+    Geometry, Ids, Relationships, Confidence scores and the document's Blocks
+    make up most of a Textract response and are never used here.
+
+    Args:
+        doc: An ExpenseDocument dictionary from the Textract response.
+
+    Returns:
+        The document with only its SummaryFields and LineItemGroups text.
+    """
+    return {
+        "SummaryFields": [
+            _compact_expense_field(field) for field in doc.get("SummaryFields", [])
+        ],
+        "LineItemGroups": [
+            {
+                "LineItems": [
+                    {
+                        "LineItemExpenseFields": [
+                            _compact_expense_field(field)
+                            for field in item.get("LineItemExpenseFields", [])
+                        ]
+                    }
+                    for item in group.get("LineItems", [])
+                ]
+            }
+            for group in doc.get("LineItemGroups", [])
+        ],
+    }
+
+
+def analyze_invoice_sync(document_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Runs synchronous AnalyzeExpense on a document passed inline, avoiding the
+    S3 upload and job polling of the asynchronous API.
+
+    Only single-page documents are supported synchronously; for anything else
+    Textract rejects the request and None is returned so that the caller can
+    fall back to analyze_invoice_primary.
+
+    Args:
+        document_bytes: The content of the document.
+
+    Returns:
+        The AnalyzeExpense results as a dictionary with compacted
+        ExpenseDocuments, or None if the document could not be analyzed
+        synchronously.
+    """
+    try:
+        logging.info("Running synchronous Textract analysis (AnalyzeExpense)...")
+        response = TEXTRACT.analyze_expense(Document={"Bytes": document_bytes})
+    except ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code")
+        logging.info(
+            f"Synchronous analysis not possible ({error_code}). Using an asynchronous job."
+        )
+        return None
+    return {
+        "ExpenseDocuments": [
+            _compact_expense_document(doc)
+            for doc in response.get("ExpenseDocuments", [])
+        ]
+    }
+
+
+def analyze_invoice_primary(
+    bucket_name: str, file_name: str, client_request_token: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
     """
-    Starts an asynchronous AnalyzeExpense job and polls for a successful
-    completion status. After success, it fetches all paginated results and
-    returns the complete JSON response.
+    Starts an asynchronous AnalyzeExpense job and waits for it to complete,
+    via SNS/SQS notification when configured or by polling otherwise. After
+    success, it fetches all paginated results and returns them merged.
 
     Args:
         bucket_name: The name of the S3 bucket containing the invoice.
         file_name: The key (filename) of the invoice in the bucket.
+        client_request_token: Optional idempotency token for the job.
 
     Returns:
-        The complete JSON response from the GetExpenseAnalysis API call as a
-        dictionary, or None if the job fails or an error occurs.
+        The GetExpenseAnalysis results as a dictionary, with the compacted
+        ExpenseDocuments of all pages merged, or None if the job fails or an
+        error occurs.
     """
-    textract_client = boto3.client("textract")
-    job_id = ""
 
-    try:
+    def start(token: Optional[str]) -> Dict[str, Any]:
         logging.info("Starting primary asynchronous Textract job (AnalyzeExpense)...")
-        response = textract_client.start_expense_analysis(
-            DocumentLocation={"S3Object": {"Bucket": bucket_name, "Name": file_name}}
+        response = _start_job(
+            TEXTRACT.start_expense_analysis,
+            DocumentLocation={"S3Object": {"Bucket": bucket_name, "Name": file_name}},
+            JobTag=_job_tag(file_name),
+            **_idempotency_args(token),
         )
-        job_id = response["JobId"]
-        logging.info(f"Primary job started with ID: {job_id}")
-
+        logging.info(f"Primary job started with ID: {response['JobId']}")
         logging.info("Waiting for primary job to complete...")
-        job_status = "IN_PROGRESS"
-        while job_status == "IN_PROGRESS":
-            time.sleep(5)
-            job_response = textract_client.get_expense_analysis(JobId=job_id)
-            job_status = job_response["JobStatus"]
-            logging.info(f"Current primary job status: {job_status}")
+        return response
+
+    try:
+        job_id, job_status = _run_job(start, "GetExpenseAnalysis", client_request_token)
+        logging.info(f"Current primary job status: {job_status}")
 
         if job_status == "SUCCEEDED":
             logging.info("Primary job completed successfully. Fetching all results...")
-            full_response = job_response
-            next_token = full_response.get("NextToken")
-            while next_token:
-                job_response = textract_client.get_expense_analysis(
-                    JobId=job_id, NextToken=next_token
+            paginator = _job_results_paginator("GetExpenseAnalysis", "ExpenseDocuments")
+            pages = _prefetch_pages(
+                paginator.paginate(
+                    JobId=job_id, PaginationConfig={"PageSize": RESULTS_PAGE_SIZE}
                 )
-                full_response["Blocks"].extend(job_response.get("Blocks", []))
-                full_response["ExpenseDocuments"].extend(
-                    job_response.get("ExpenseDocuments", [])
+            )
+            # Compact each page as it arrives so that only the fields parsed
+            # later are kept in memory across the whole document.
+            expense_documents = []
+            for page in pages:
+                expense_documents.extend(
+                    _compact_expense_document(doc)
+                    for doc in page.get("ExpenseDocuments", [])
                 )
-                next_token = job_response.get("NextToken")
-            full_response.pop("NextToken", None)
-            return full_response
+            return {"JobStatus": job_status, "ExpenseDocuments": expense_documents}
+        elif job_status == "IN_PROGRESS":
+            # The timeout or interruption was already logged by _wait_for_job.
+            return None
         else:
             logging.error(f"Primary Textract job failed with status: {job_status}")
             return None
@@ -256,7 +1079,7 @@ def merge_invoice_documents(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 
     Some multi-page invoices are returned as separate document sections. This
     function consolidates them by merging LineItemGroups and non-duplicate
-    SummaryFields into the first document section.
+    SummaryFields into a copy of the first document section.
 
     Args:
         docs: A list of ExpenseDocument dictionaries from the Textract response.
@@ -267,22 +1090,22 @@ def merge_invoice_documents(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     if not docs or len(docs) <= 1:
         return docs
     logging.info(f"Multiple ({len(docs)}) document sections found. Merging.")
-    primary_doc = docs[0]
-    if "LineItemGroups" not in primary_doc:
-        primary_doc["LineItemGroups"] = []
-    if "SummaryFields" not in primary_doc:
-        primary_doc["SummaryFields"] = []
-    primary_field_types = {
-        f.get("Type", {}).get("Text") for f in primary_doc.get("SummaryFields", [])
-    }
-    for subsequent_doc in docs[1:]:
-        if subsequent_doc.get("LineItemGroups"):
-            primary_doc["LineItemGroups"].extend(subsequent_doc.get("LineItemGroups"))
-        for field in subsequent_doc.get("SummaryFields", []):
-            field_type = field.get("Type", {}).get("Text")
-            if field_type and field_type not in primary_field_types:
-                primary_doc["SummaryFields"].append(field)
-                primary_field_types.add(field_type)
+    primary_doc = dict(docs[0])
+    primary_doc["LineItemGroups"] = list(
+        chain.from_iterable(doc.get("LineItemGroups") or [] for doc in docs)
+    )
+    # All fields of the first section are kept; later sections only add
+    # fields of types not seen before.
+    summary_fields = list(primary_doc.get("SummaryFields", []))
+    seen_field_types = {f.get("Type", {}).get("Text") for f in summary_fields}
+    for field in chain.from_iterable(
+        doc.get("SummaryFields", []) for doc in docs[1:]
+    ):
+        field_type = field.get("Type", {}).get("Text")
+        if field_type and field_type not in seen_field_types:
+            summary_fields.append(field)
+            seen_field_types.add(field_type)
+    primary_doc["SummaryFields"] = summary_fields
     return [primary_doc]
 
 
@@ -308,21 +1131,31 @@ def parse_extracted_data(response: Optional[Dict[str, Any]]) -> List[Dict[str, A
 
     for doc in merged_docs:
         extracted_data = {}
-        summary_fields = {
-            f.get("Type", {}).get("Text"): f.get("ValueDetection", {}).get("Text")
-            for f in doc.get("SummaryFields", [])
-        }
-        extracted_data["Invoice Number"] = summary_fields.get(
-            "INVOICE_RECEIPT_ID", "N/A"
-        )
-        raw_date = summary_fields.get("INVOICE_RECEIPT_DATE", "N/A")
+        summary_fields = doc.get("SummaryFields", [])
+
+        # Single pass over the summary fields, keeping only the known types.
+        # Later fields of the same type take precedence.
+        invoice_number = raw_date = invoice_total = "N/A"
+        payment_terms_value = terms_value = None
+        for field in summary_fields:
+            field_type = field.get("Type", {}).get("Text")
+            if field_type == "INVOICE_RECEIPT_ID":
+                invoice_number = field.get("ValueDetection", {}).get("Text")
+            elif field_type == "INVOICE_RECEIPT_DATE":
+                raw_date = field.get("ValueDetection", {}).get("Text")
+            elif field_type == "TOTAL":
+                invoice_total = field.get("ValueDetection", {}).get("Text")
+            elif field_type == "PAYMENT_TERMS":
+                payment_terms_value = field.get("ValueDetection", {}).get("Text")
+            elif field_type == "TERMS":
+                terms_value = field.get("ValueDetection", {}).get("Text")
+
+        extracted_data["Invoice Number"] = invoice_number
         extracted_data["Invoice Date"] = standardize_date(raw_date)
         
-        extracted_data["Invoice Total"] = summary_fields.get("TOTAL", "N/A")
+        extracted_data["Invoice Total"] = invoice_total
 
-        payment_terms_value = summary_fields.get("PAYMENT_TERMS") or summary_fields.get(
-            "TERMS"
-        )
+        payment_terms_value = payment_terms_value or terms_value
         payment_terms = (
             payment_terms_value
             if payment_terms_value and payment_terms_value.strip()
@@ -334,21 +1167,34 @@ def parse_extracted_data(response: Optional[Dict[str, Any]]) -> List[Dict[str, A
         # PRIMARY METHOD: Process standard LineItemGroups
         for group in doc.get("LineItemGroups", []):
             for item in group.get("LineItems", []):
-                raw_fields = {
-                    f.get("Type", {})
-                    .get("Text"): f.get("ValueDetection", {})
-                    .get("Text")
-                    for f in item.get("LineItemExpenseFields", [])
-                }
-                if "ITEM" not in raw_fields:
+                # Single pass over the fields, keeping only the known types.
+                # Later fields of the same type take precedence.
+                has_item = False
+                description = price_str = amount_value = None
+                quantity_str = unit_price_str = hours_str = rate_str = None
+                for field in item.get("LineItemExpenseFields", []):
+                    field_type = field.get("Type", {}).get("Text")
+                    value = field.get("ValueDetection", {}).get("Text")
+                    if field_type == "ITEM":
+                        has_item = True
+                        description = value
+                    elif field_type == "PRICE":
+                        price_str = value
+                    elif field_type == "AMOUNT":
+                        amount_value = value
+                    elif field_type == "QUANTITY":
+                        quantity_str = value
+                    elif field_type == "UNIT_PRICE":
+                        unit_price_str = value
+                    elif field_type == "HOURS":
+                        hours_str = value
+                    elif field_type == "RATE":
+                        rate_str = value
+                if not has_item:
                     continue
 
-                line_item_details = {"Description": raw_fields.get("ITEM")}
-                amount_str = raw_fields.get("PRICE") or raw_fields.get("AMOUNT") # The total amount for the line item is usually 'PRICE'
-                quantity_str = raw_fields.get("QUANTITY")  
-                unit_price_str = raw_fields.get("UNIT_PRICE") 
-                hours_str = raw_fields.get("HOURS")
-                rate_str = raw_fields.get("RATE")
+                line_item_details = {"Description": description}
+                amount_str = price_str or amount_value # The total amount for the line item is usually 'PRICE'
 
                 line_item_details["Amount"] = amount_str
 
@@ -375,39 +1221,14 @@ def parse_extracted_data(response: Optional[Dict[str, Any]]) -> List[Dict[str, A
             logging.info(
                 "No standard line items found. Checking SummaryFields for fallback items."
             )
-            # Define summary fields that should NOT be treated as line items
-            excluded_summary_types = {
-                "TOTAL",
-                "TAX",
-                "INVOICE_RECEIPT_ID",
-                "INVOICE_RECEIPT_DATE",
-                "VENDOR_NAME",
-                "VENDOR_ADDRESS",
-                "RECEIVER_NAME",
-                "RECEIVER_ADDRESS",
-                "DUE_DATE",
-                "PAYMENT_TERMS",
-                "TERMS",
-                "SHIPPING_HANDLING_CHARGE",
-                "GRATUITY",
-                "ADDRESS",
-                "STREET",
-                "CITY",
-                "STATE",
-                "ZIP_CODE",
-                "NAME",
-                "ADDRESS_BLOCK",
-                "CLIENT_MATTER",
-                "CLIENT_ID",
-            }
-            for field in doc.get("SummaryFields", []):
+            for field in summary_fields:
                 field_type_text = field.get("Type", {}).get("Text")
                 amount = field.get("ValueDetection", {}).get("Text")
 
                 # Use _parse_float for robust number check 
                 if (
                     field_type_text
-                    and field_type_text not in excluded_summary_types
+                    and field_type_text not in EXCLUDED_SUMMARY_TYPES
                     and amount
                     and _parse_float(amount) is not None
                 ):
@@ -432,54 +1253,53 @@ def display_results(file_name: str, invoice_list: List[Dict[str, Any]]) -> None:
         file_name: The name of the file being displayed.
         invoice_list: A list of parsed invoice data dictionaries.
     """
-    print("\n" + "=" * 100)
-    print(f"Extraction Results for: {file_name}")
-    print("=" * 100)
+    # Collect the output lines and write them at once, rather than issuing a
+    # separate write per line.
+    lines = []
+    lines.append("\n" + "=" * 100)
+    lines.append(f"Extraction Results for: {file_name}")
+    lines.append("=" * 100)
 
     if not invoice_list:
-        print("No data was extracted.")
-        print("=" * 100 + "\n")
+        lines.append("No data was extracted.")
+        lines.append("=" * 100 + "\n")
+        sys.stdout.write("\n".join(lines) + "\n")
         return
 
     for idx, data in enumerate(invoice_list):
         if len(invoice_list) > 1:
-            print(f"\n--- Invoice Document {idx + 1} of {len(invoice_list)} ---")
+            lines.append(f"\n--- Invoice Document {idx + 1} of {len(invoice_list)} ---")
 
-        print(f"Invoice Number: {data.get('Invoice Number', 'N/A')}")
-        print(f"Invoice Date:   {data.get('Invoice Date', 'N/A')}")
-        print(f"Invoice Total:  {data.get('Invoice Total', 'N/A')}")
+        lines.append(f"Invoice Number: {data.get('Invoice Number', 'N/A')}")
+        lines.append(f"Invoice Date:   {data.get('Invoice Date', 'N/A')}")
+        lines.append(f"Invoice Total:  {data.get('Invoice Total', 'N/A')}")
 
         payment_terms = data.get("Payment Terms", "N/A")
-        wrapped_terms = textwrap.fill(
-            payment_terms,
-            width=98,
-            initial_indent="Payment Terms:  ",
-            subsequent_indent="                ",
-        )
-        print(wrapped_terms)
+        wrapped_terms = _TERMS_WRAPPER.fill(payment_terms)
+        lines.append(wrapped_terms)
 
         line_items = data.get("Line Items")
         if not line_items:
-            print("\n--- Line Items ---")
-            print("  No line items found.")
+            lines.append("\n--- Line Items ---")
+            lines.append("  No line items found.")
             continue
 
-        print("\n--- Line Items ---")
+        lines.append("\n--- Line Items ---")
 
         first_item = next((item for item in line_items if item), None)
         is_service_invoice = (
             first_item and "Hours" in first_item and first_item.get("Hours") is not None
         )
 
-        desc_width = 50
+        desc_width = _DESC_WRAPPER.width
         num_width = 4
         if is_service_invoice:
             header = f"{'#':<{num_width}} | {'Description':<{desc_width}} | {'Hours':<8} | {'Rate':<15} | {'Amount':<15}"
         else:
             header = f"{'#':<{num_width}} | {'Description':<{desc_width}} | {'Qty':<8} | {'Unit Price':<15} | {'Amount':<15}"
 
-        print(header)
-        print("-" * len(header))
+        lines.append(header)
+        lines.append("-" * len(header))
 
         num_items = len(line_items)
         for i, item in enumerate(line_items):
@@ -489,7 +1309,7 @@ def display_results(file_name: str, invoice_list: List[Dict[str, Any]]) -> None:
             )
             item_num_str = f"{(i + 1):<{num_width}}"
 
-            wrapped_desc_lines = textwrap.wrap(desc, width=desc_width)
+            wrapped_desc_lines = _DESC_WRAPPER.wrap(desc)
             first_desc_line = wrapped_desc_lines[0] if wrapped_desc_lines else ""
 
             if is_service_invoice:
@@ -497,7 +1317,7 @@ def display_results(file_name: str, invoice_list: List[Dict[str, Any]]) -> None:
                 rate = item.get("Rate")
                 hours_str = str(hours) if hours is not None else "N/A"
                 rate_str = str(rate) if rate is not None else "N/A"
-                print(
+                lines.append(
                     f"{item_num_str} | {first_desc_line:<{desc_width}} | {hours_str:<8} | {rate_str:<15} | {amount_str:<15}"
                 )
             else:
@@ -505,74 +1325,321 @@ def display_results(file_name: str, invoice_list: List[Dict[str, Any]]) -> None:
                 price = item.get("Unit Price")
                 qty_str = str(qty) if qty is not None else "N/A"
                 price_str = str(price) if price is not None else "N/A"
-                print(
+                lines.append(
                     f"{item_num_str} | {first_desc_line:<{desc_width}} | {qty_str:<8} | {price_str:<15} | {amount_str:<15}"
                 )
 
             if len(wrapped_desc_lines) > 1:
                 for line in wrapped_desc_lines[1:]:
-                    print(
+                    lines.append(
                         f"{'':<{num_width}} | {line:<{desc_width}} | {'':<8} | {'':<15} | {'':<15}"
                     )
 
             if i < num_items - 1:
-                print(
+                lines.append(
                     f"{'-'*num_width} | {'-'*desc_width} | {'-'*8} | {'-'*15} | {'-'*15}"
                 )
 
-    print("=" * 100 + "\n")
+    lines.append("=" * 100 + "\n")
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
-def main():
+def delete_uploaded_objects(keys: List[str]) -> None:
     """
-    Main function to orchestrate the invoice processing.
+    Deletes uploaded invoices from the S3 bucket, batching up to 1000 keys
+    per DeleteObjects request.
+
+    Args:
+        keys: The keys of the objects to delete.
     """
-    parser = argparse.ArgumentParser(
-        description="Process invoices using AWS Textract."
+    keys = list(dict.fromkeys(keys))
+    for start in range(0, len(keys), 1000):
+        batch = keys[start : start + 1000]
+        logging.info(
+            f"Deleting {len(batch)} object(s) from S3 bucket {S3_BUCKET_NAME}."
+        )
+        try:
+            response = S3.delete_objects(
+                Bucket=S3_BUCKET_NAME,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+        except ClientError as e:
+            logging.warning(f"Could not delete {', '.join(batch)} from S3: {e}")
+            continue
+        for error in response.get("Errors", []):
+            logging.warning(
+                f"Could not delete {error.get('Key')} from S3: "
+                f"{error.get('Code')} - {error.get('Message')}"
+            )
+
+
+async def _fill_missing_payment_terms(
+    parsed_data: List[Dict[str, Any]],
+    find_payment_terms: Callable[..., Optional[str]],
+    *args: Any,
+) -> bool:
+    """
+    Fills in the payment terms of invoices for which the primary analysis found
+    none, running the fallback in a worker thread only if it is needed.
+
+    Args:
+        parsed_data: The parsed invoices, updated in place.
+        find_payment_terms: The fallback function returning the payment terms.
+        *args: The arguments for the fallback function.
+
+    Returns:
+        False if the fallback raised an error, True otherwise.
+    """
+    missing_terms = [
+        invoice_data
+        for invoice_data in parsed_data
+        if not invoice_data.get("Payment Terms")
+    ]
+    if missing_terms:
+        logging.warning("Primary method failed for payment terms. Trying fallback.")
+        try:
+            fallback_terms = await asyncio.to_thread(find_payment_terms, *args)
+        except Exception as e:
+            logging.error(f"An error occurred during fallback processing: {e}")
+            fallback_terms = None
+            succeeded = False
+        else:
+            succeeded = True
+        for invoice_data in missing_terms:
+            invoice_data["Payment Terms"] = fallback_terms or "Not available"
+        return succeeded
+    return True
+
+
+async def _process_inline(
+    file_path: str,
+) -> Tuple[Optional[List[Dict[str, Any]]], bool]:
+    """
+    Extracts a small invoice with the synchronous Textract APIs, sending the
+    document inline instead of through S3.
+
+    Args:
+        file_path: The local path of the invoice file.
+
+    Returns:
+        The parsed invoices, or None if the document is not supported by the
+        synchronous APIs (e.g. a multi-page PDF), and whether the payment
+        terms fallback (if needed) completed without errors.
+    """
+    document_bytes = await asyncio.to_thread(Path(file_path).read_bytes)
+    textract_response = await asyncio.to_thread(analyze_invoice_sync, document_bytes)
+    if not textract_response:
+        return None, False
+
+    parsed_data = parse_extracted_data(textract_response)
+    complete = await _fill_missing_payment_terms(
+        parsed_data, fallback_find_payment_terms_sync, document_bytes
     )
-    parser.add_argument(
-        "files", metavar="FILE", nargs="+", help="Paths to invoice PDF files."
+    return parsed_data, complete
+
+
+async def _process_via_s3(
+    file_path: str, file_name: str, digest: str, uploaded_keys: List[str]
+) -> Tuple[Optional[List[Dict[str, Any]]], bool]:
+    """
+    Extracts an invoice with asynchronous Textract jobs on a copy uploaded to S3.
+
+    Args:
+        file_path: The local path of the invoice file.
+        file_name: The name of the invoice file.
+        digest: The SHA-256 hex digest of the file content.
+        uploaded_keys: Collects the keys to delete from S3 once all files are
+            processed.
+
+    Returns:
+        The parsed invoices, or None if the primary analysis failed, and
+        whether the payment terms fallback (if needed) completed without
+        errors.
+    """
+    # Files with the same name from different directories must not share an
+    # S3 key, so the key is prefixed with the content digest.
+    object_name = f"{digest}/{file_name}"
+
+    # Upload file to S3. The key is recorded first so that a partial upload
+    # is cleaned up too.
+    uploaded_keys.append(object_name)
+    logging.info(f"Uploading {file_path} to s3://{S3_BUCKET_NAME}/{object_name}...")
+    await asyncio.to_thread(
+        S3.upload_file,
+        file_path,
+        S3_BUCKET_NAME,
+        object_name,
+        Config=TRANSFER_CFG,
     )
-    args = parser.parse_args()
+    logging.info("Upload successful.")
+
+    # Re-running on an unchanged file reuses its existing Textract jobs.
+    client_request_token = _client_request_token(S3_BUCKET_NAME, digest)
+
+    # Run primary analysis (AnalyzeExpense)
+    textract_response = await asyncio.to_thread(
+        analyze_invoice_primary,
+        S3_BUCKET_NAME,
+        object_name,
+        client_request_token,
+    )
+    if not textract_response:
+        return None, False
+
+    # Parse the primary results, running the fallback if necessary
+    parsed_data = parse_extracted_data(textract_response)
+    complete = await _fill_missing_payment_terms(
+        parsed_data,
+        fallback_find_payment_terms,
+        S3_BUCKET_NAME,
+        object_name,
+        client_request_token,
+    )
+    return parsed_data, complete
+
+
+def open_result_cache(path: str) -> Optional[sqlite3.Connection]:
+    """
+    Opens (creating it if needed) the local cache of parsed invoice results.
+
+    Args:
+        path: The path of the SQLite database file.
+
+    Returns:
+        The open database connection, or None if the cache cannot be used
+        (e.g. its directory is missing or not writable).
+    """
+    try:
+        cache = sqlite3.connect(path)
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS results"
+            " (sha256 TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+    except sqlite3.Error as e:
+        logging.warning(f"Could not open result cache {path}, continuing without it: {e}")
+        return None
+    return cache
+
+
+def get_cached_result(
+    cache: sqlite3.Connection, digest: str
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Looks up the parsed results of a previously processed file.
+
+    Args:
+        cache: The result cache (see open_result_cache).
+        digest: The SHA-256 hex digest of the file content.
+
+    Returns:
+        The cached parsed invoices, or None if the file was not processed before
+        or the cache could not be read.
+    """
+    try:
+        row = cache.execute(
+            "SELECT data FROM results WHERE sha256 = ?", (digest,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"Could not read from result cache: {e}")
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def store_cached_result(
+    cache: sqlite3.Connection, digest: str, parsed_data: List[Dict[str, Any]]
+) -> None:
+    """
+    Stores the parsed results of a file in the cache.
+
+    Args:
+        cache: The result cache (see open_result_cache).
+        digest: The SHA-256 hex digest of the file content.
+        parsed_data: The parsed invoices to store.
+    """
+    try:
+        with cache:
+            cache.execute(
+                "INSERT OR REPLACE INTO results (sha256, data) VALUES (?, ?)",
+                (digest, json.dumps(parsed_data)),
+            )
+    except sqlite3.Error as e:
+        # e.g. the database is locked by another run; the results were
+        # already displayed, so only the caching is lost.
+        logging.warning(f"Could not store results in the result cache: {e}")
 
-    s3_client = boto3.client("s3")
 
-    for file_path in args.files:
-        file_name = os.path.basename(file_path)
+def _file_sha256(file_path: str) -> str:
+    """
+    Computes the SHA-256 hex digest of a file's content.
+
+    Args:
+        file_path: The local path of the file.
+
+    Returns:
+        The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def process_file(
+    file_path: str,
+    semaphore: asyncio.Semaphore,
+    uploaded_keys: List[str],
+    cache: Optional[sqlite3.Connection] = None,
+    refresh_cache: bool = False,
+) -> None:
+    """
+    Runs the full pipeline (analysis, fallback, display) for a single invoice
+    file.
+
+    Files whose content was processed before are displayed from the result
+    cache without calling AWS. Documents of up to SYNC_MAX_DOCUMENT_BYTES are
+    first tried with the synchronous Textract APIs. Larger or multi-page
+    documents go through S3 and asynchronous jobs.
+
+    The blocking boto3 calls are run in worker threads so that several files
+    can be processed concurrently from the event loop.
+
+    Args:
+        file_path: The local path of the invoice file.
+        semaphore: Bounds the number of files processed at the same time.
+        uploaded_keys: Collects the keys of files uploaded to S3.
+        cache: Optional result cache (see open_result_cache).
+        refresh_cache: Whether to process the file again even if it is cached,
+            replacing the cached results.
+    """
+    file_name = os.path.basename(file_path)
+
+    async with semaphore:
         logging.info(f"--- Starting processing for {file_name} ---")
 
         try:
-            # Upload file to S3
-            logging.info(f"Uploading {file_name} to S3 bucket {S3_BUCKET_NAME}...")
-            s3_client.upload_file(file_path, S3_BUCKET_NAME, file_name)
-            logging.info("Upload successful.")
-
-            # Run primary analysis (AnalyzeExpense)
-            textract_response = analyze_invoice_primary(S3_BUCKET_NAME, file_name)
-
-            if textract_response:
-                # Parse the primary results
-                parsed_data = parse_extracted_data(textract_response)
-
-                # Check for payment terms and run fallback if necessary
-                for invoice_data in parsed_data:
-                    if not invoice_data.get("Payment Terms"):
-                        logging.warning(
-                            "Primary method failed for payment terms. Trying fallback."
-                        )
-                        fallback_terms = fallback_find_payment_terms(
-                            S3_BUCKET_NAME, file_name
-                        )
-                        invoice_data["Payment Terms"] = (
-                            fallback_terms or "Not available"
-                        )
-                    else:
-                        # If primary method worked, ensure "Not available" is not the final value
-                        invoice_data["Payment Terms"] = (
-                            invoice_data.get("Payment Terms") or "Not available"
-                        )
+            parsed_data = None
+            digest = await asyncio.to_thread(_file_sha256, file_path)
+            if cache is not None and not refresh_cache:
+                parsed_data = get_cached_result(cache, digest)
+
+            cached = parsed_data is not None
+            if cached:
+                logging.info(f"Using cached results for {file_name}.")
+            else:
+                if os.path.getsize(file_path) <= SYNC_MAX_DOCUMENT_BYTES:
+                    parsed_data, complete = await _process_inline(file_path)
+                if parsed_data is None:
+                    parsed_data, complete = await _process_via_s3(
+                        file_path, file_name, digest, uploaded_keys
+                    )
 
+            if parsed_data is not None:
                 display_results(file_name, parsed_data)
+                # Results with no invoices, or whose fallback failed, are not
+                # cached so that the next run tries again.
+                if not cached and parsed_data and complete and cache is not None:
+                    store_cached_result(cache, digest, parsed_data)
             else:
                 logging.error(
                     f"Failed to get a valid response from Textract for {file_name}. Skipping."
@@ -584,18 +1651,73 @@ def main():
             logging.error(f"An AWS client error occurred: {e}")
         except Exception as e:
             logging.error(f"An unexpected error occurred: {e}")
-        finally:
-            # Clean up the S3 object in all cases 
-            try:
-                logging.info(f"Deleting {file_name} from S3 bucket {S3_BUCKET_NAME}.")
-                s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=file_name)
-            except ClientError as e:
-                logging.warning(f"Could not delete {file_name} from S3: {e}")
 
         logging.info(f"--- Finished processing for {file_name} ---")
         print("-"*10 + "#"*100 + "-"*10 + "\n")
-        
- 
+
+
+async def process_files(file_paths: List[str], refresh_cache: bool = False) -> None:
+    """
+    Processes all invoice files concurrently, at most MAX_CONCURRENT_FILES at a time.
+
+    The blocking steps run on a dedicated pool of MAX_CONCURRENT_FILES worker
+    threads, as each file holds a thread while waiting for its Textract jobs.
+    When processing ends or is interrupted (e.g. with Ctrl-C), the remaining
+    job waits are stopped so that the cleanup runs right away.
+
+    Args:
+        file_paths: The local paths of the invoice files.
+        refresh_cache: Whether to process every file again instead of reusing
+            the local result cache. The new results are still stored in it.
+    """
+    # The default executor can have fewer threads than MAX_CONCURRENT_FILES
+    # (min(32, cpu_count + 4)).
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILES)
+    )
+    _stop_waiting.clear()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+    uploaded_keys: List[str] = []
+    cache = open_result_cache(CACHE_PATH)
+    try:
+        await asyncio.gather(
+            *(
+                process_file(
+                    file_path, semaphore, uploaded_keys, cache, refresh_cache
+                )
+                for file_path in file_paths
+            )
+        )
+    finally:
+        _stop_job_waits()
+        # Clean up the uploaded S3 objects in all cases
+        if uploaded_keys:
+            await asyncio.to_thread(delete_uploaded_objects, uploaded_keys)
+        if cache is not None:
+            cache.close()
+
+
+def main():
+    """
+    Main function to orchestrate the invoice processing.
+    """
+    parser = argparse.ArgumentParser(
+        description="Process invoices using AWS Textract."
+    )
+    parser.add_argument(
+        "files", metavar="FILE", nargs="+", help="Paths to invoice PDF files."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Ignore cached results and process every file with Textract again, "
+            "replacing the cached results."
+        ),
+    )
+    args = parser.parse_args()
+
+    asyncio.run(process_files(args.files, refresh_cache=args.no_cache))
 
 
 if __name__ == "__main__":